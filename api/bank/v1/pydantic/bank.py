@@ -1,4 +1,6 @@
+from bank.v1.pydantic.account import OverdraftError
 from reboot.api import API, Field, Methods, Model, Reader, Transaction, Type
+from typing import Optional
 
 
 class BankState(Model):
@@ -9,8 +11,30 @@ class SignUpRequest(Model):
     customer_id: str = Field(tag=1)
 
 
+class AllCustomerIdsRequest(Model):
+    # Customers are keyed by the uuid7 they were signed up with, so
+    # keys are ordered by sign up time, to the millisecond. `start_key`
+    # is inclusive and `end_key` is exclusive.
+    start_key: Optional[str] = Field(tag=1, default=None)
+    end_key: Optional[str] = Field(tag=2, default=None)
+    # Only customers signed up in `[created_after_ms,
+    # created_before_ms)`, in milliseconds since the Unix epoch.
+    created_after_ms: Optional[int] = Field(tag=3, default=None)
+    created_before_ms: Optional[int] = Field(tag=4, default=None)
+    # The `next_page_token` of a previous response.
+    page_token: Optional[str] = Field(tag=5, default=None)
+    # How many customers to return, between 1 and 1000; 32 if unset.
+    limit: Optional[int] = Field(tag=6, default=None)
+
+
+class InvalidCustomerIdsRequestError(Model):
+    message: str = Field(tag=1)
+
+
 class AllCustomerIdsResponse(Model):
     customer_ids: list[str] = Field(tag=1)
+    # Set if there are more customers to fetch with this token.
+    next_page_token: Optional[str] = Field(tag=2, default=None)
 
 
 class TransferRequest(Model):
@@ -19,6 +43,10 @@ class TransferRequest(Model):
     amount: float = Field(tag=3)
 
 
+class TransferBatchRequest(Model):
+    transfers: list[TransferRequest] = Field(tag=1)
+
+
 class OpenCustomerAccountRequest(Model):
     initial_deposit: float = Field(tag=1)
     customer_id: str = Field(tag=2)
@@ -51,13 +79,23 @@ BankMethods = Methods(
         mcp=None,
     ),
     all_customer_ids=Reader(
-        request=None,
+        request=AllCustomerIdsRequest,
         response=AllCustomerIdsResponse,
+        errors=[InvalidCustomerIdsRequestError],
         mcp=None,
     ),
     transfer=Transaction(
         request=TransferRequest,
         response=None,
+        errors=[OverdraftError],
+        mcp=None,
+    ),
+    # Applies many transfers as a single transaction, netting the
+    # amounts per account so each account is touched at most once.
+    transfer_batch=Transaction(
+        request=TransferBatchRequest,
+        response=None,
+        errors=[OverdraftError],
         mcp=None,
     ),
     open_customer_account=Transaction(
@@ -1,15 +1,52 @@
 import asyncio
 import uuid
 from bank.v1.proto.customer_rbt import Customer
+from bank.v1.pydantic.account import OverdraftError
 from bank.v1.pydantic.account_rbt import Account
-from bank.v1.pydantic.bank import CustomerAccount, CustomerAccounts
+from bank.v1.pydantic.bank import (
+    CustomerAccount,
+    CustomerAccounts,
+    InvalidCustomerIdsRequestError,
+)
 from bank.v1.pydantic.bank_rbt import Bank
+from collections import defaultdict
 from google.protobuf.message import Message
 from rbt.std.collections.v1.sorted_map_rbt import SortedMap
 from reboot.aio.auth.authorizers import allow
 from reboot.aio.contexts import ReaderContext, TransactionContext
+from typing import Optional
 from uuid7 import create as uuid7
 
+DEFAULT_CUSTOMER_IDS_LIMIT = 32
+
+MAX_CUSTOMER_IDS_LIMIT = 1000
+
+# A uuid7 only has room for a 48 bit millisecond timestamp.
+MAX_UUID7_TIMESTAMP_MS = 2**48 - 1
+
+# Net amounts smaller than this are floating point noise from summing
+# transfers that cancel out, not money to move.
+NET_AMOUNT_EPSILON = 1e-9
+
+
+def _uuid7_key_prefix(timestamp_ms: int) -> str:
+    """Returns the prefix of the uuid7 keys created at `timestamp_ms`.
+
+    A uuid7 starts with its 48 bit millisecond timestamp, so this
+    prefix sorts before every key created at or after `timestamp_ms`
+    and after every key created before it.
+    """
+    timestamp = f'{timestamp_ms:012x}'
+    return f'{timestamp[:8]}-{timestamp[8:]}'
+
+
+def _max_key(*keys: Optional[str]) -> Optional[str]:
+    return max((key for key in keys if key is not None), default=None)
+
+
+def _min_key(*keys: Optional[str]) -> Optional[str]:
+    return min((key for key in keys if key is not None), default=None)
+
 
 class BankServicer(Bank.Servicer):
 
@@ -41,16 +78,78 @@ class BankServicer(Bank.Servicer):
     async def all_customer_ids(
         self,
         context: ReaderContext,
+        request: Bank.AllCustomerIdsRequest,
     ) -> Bank.AllCustomerIdsResponse:
+        if request.limit is not None and not (
+            1 <= request.limit <= MAX_CUSTOMER_IDS_LIMIT
+        ):
+            raise Bank.AllCustomerIdsAborted(
+                InvalidCustomerIdsRequestError(
+                    message=(
+                        f"'limit' must be between 1 and "
+                        f"{MAX_CUSTOMER_IDS_LIMIT}, got {request.limit}"
+                    ),
+                )
+            )
+
+        for name, timestamp_ms in [
+            ('created_after_ms', request.created_after_ms),
+            ('created_before_ms', request.created_before_ms),
+        ]:
+            if timestamp_ms is not None and not (
+                0 <= timestamp_ms <= MAX_UUID7_TIMESTAMP_MS
+            ):
+                raise Bank.AllCustomerIdsAborted(
+                    InvalidCustomerIdsRequestError(
+                        message=(
+                            f"'{name}' must be between 0 and "
+                            f"{MAX_UUID7_TIMESTAMP_MS}, got {timestamp_ms}"
+                        ),
+                    )
+                )
+
+        limit = (
+            DEFAULT_CUSTOMER_IDS_LIMIT
+            if request.limit is None else request.limit
+        )
+
+        # Narrow the range to the intersection of all of the filters;
+        # the page token is just the first key of the next page.
+        start_key = _max_key(
+            request.start_key,
+            request.page_token,
+            None if request.created_after_ms is None else
+            _uuid7_key_prefix(request.created_after_ms),
+        )
+        end_key = _min_key(
+            request.end_key,
+            None if request.created_before_ms is None else
+            _uuid7_key_prefix(request.created_before_ms),
+        )
+
+        if start_key is not None and end_key is not None and (
+            start_key >= end_key
+        ):
+            return Bank.AllCustomerIdsResponse(customer_ids=[])
+
+        # Fetch one extra entry to know whether there is another page.
         customer_ids_map = SortedMap.ref(self.state.customer_ids_map_id)
-        customer_ids = await customer_ids_map.range(context, limit=32)
+        customer_ids = await customer_ids_map.range(
+            context,
+            start_key=start_key,
+            end_key=end_key,
+            limit=limit + 1,
+        )
 
         assert isinstance(customer_ids, Message)
 
+        entries = list(customer_ids.entries)
+
         return Bank.AllCustomerIdsResponse(
-            customer_ids=[
-                entry.value.decode() for entry in customer_ids.entries
-            ]
+            customer_ids=[entry.value.decode() for entry in entries[:limit]],
+            next_page_token=(
+                entries[limit].key if len(entries) > limit else None
+            ),
         )
 
     async def transfer(
@@ -61,9 +160,50 @@ class BankServicer(Bank.Servicer):
         from_account = Account.ref(request.from_account_id)
         to_account = Account.ref(request.to_account_id)
 
-        await from_account.withdraw(context, amount=request.amount)
+        try:
+            await from_account.withdraw(context, amount=request.amount)
+        except Account.WithdrawAborted as aborted:
+            if not isinstance(aborted.error, OverdraftError):
+                raise
+            raise Bank.TransferAborted(aborted.error)
+
         await to_account.deposit(context, amount=request.amount)
 
+    async def transfer_batch(
+        self,
+        context: TransactionContext,
+        request: Bank.TransferBatchRequest,
+    ) -> None:
+        # Net all of the transfers per account so that we do at most
+        # one withdraw or deposit per account. Note that this means
+        # only the final balance of each account is checked for an
+        # overdraft, not the balance after each individual transfer.
+        net_amounts: defaultdict[str, float] = defaultdict(float)
+        for transfer in request.transfers:
+            net_amounts[transfer.from_account_id] -= transfer.amount
+            net_amounts[transfer.to_account_id] += transfer.amount
+
+        # Withdraw before depositing, like `transfer` does, so that an
+        # overdraft aborts the transaction before any deposits.
+        for account_id, amount in sorted(net_amounts.items()):
+            if amount <= -NET_AMOUNT_EPSILON:
+                try:
+                    await Account.ref(account_id).withdraw(
+                        context,
+                        amount=-amount,
+                    )
+                except Account.WithdrawAborted as aborted:
+                    if not isinstance(aborted.error, OverdraftError):
+                        raise
+                    raise Bank.TransferBatchAborted(aborted.error)
+
+        for account_id, amount in sorted(net_amounts.items()):
+            if amount >= NET_AMOUNT_EPSILON:
+                await Account.ref(account_id).deposit(
+                    context,
+                    amount=amount,
+                )
+
     async def open_customer_account(
         self,
         context: TransactionContext,
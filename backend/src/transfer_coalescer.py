@@ -0,0 +1,158 @@
+import asyncio
+import uuid
+from bank.v1.pydantic.bank_rbt import Bank
+from datetime import timedelta
+from reboot.aio.external import ExternalContext
+from typing import Optional
+
+# How long to wait for more transfers after the first transfer of a
+# batch arrives. Callers pay at most this much extra latency.
+DEFAULT_WINDOW = timedelta(milliseconds=5)
+
+DEFAULT_MAX_BATCH_SIZE = 100
+
+# How many times to try a call whose outcome is unknown, e.g., because
+# of a network failure, before giving up.
+MAX_ATTEMPTS = 3
+
+
+class TransferCoalescer:
+    """Opt-in micro-batching stage in front of `Bank.transfer`.
+
+    Transfers that arrive within `window` of each other are sent to the
+    bank as one `Bank.transfer_batch` transaction, which nets the
+    amounts per account. Opting in changes overdraft semantics: only
+    each account's net amount is checked, so a transfer that would
+    overdraw an account on its own can succeed when other transfers in
+    the same batch cover it.
+
+    If the batch is aborted, e.g., because some account's net amount
+    would overdraw it, nothing was applied, and each transfer of the
+    batch is retried individually so that every caller gets its own
+    result. Calls whose outcome is unknown are retried with the same
+    idempotency key; if they keep failing every caller of the batch
+    gets the error, since the batch may or may not have been applied.
+    """
+
+    def __init__(
+        self,
+        context: ExternalContext,
+        bank_id: str,
+        *,
+        window: timedelta = DEFAULT_WINDOW,
+        max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+    ):
+        self._context = context
+        self._bank_id = bank_id
+        self._window = window
+        self._max_batch_size = max_batch_size
+        self._pending: list[tuple[Bank.TransferRequest,
+                                  asyncio.Future[None]]] = []
+        self._timer: Optional[asyncio.Task] = None
+        # Hold on to running batches so they aren't garbage collected.
+        self._batches: set[asyncio.Task] = set()
+
+    async def transfer(self, request: Bank.TransferRequest) -> None:
+        future: asyncio.Future[None] = (
+            asyncio.get_running_loop().create_future()
+        )
+        self._pending.append((request, future))
+
+        if len(self._pending) >= self._max_batch_size:
+            self._flush()
+        elif len(self._pending) == 1:
+            self._timer = asyncio.create_task(self._flush_after_window())
+
+        await future
+
+    async def _flush_after_window(self) -> None:
+        await asyncio.sleep(self._window.total_seconds())
+        self._timer = None
+        self._flush()
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        batch, self._pending = self._pending, []
+
+        task = asyncio.create_task(self._run(batch))
+        self._batches.add(task)
+        task.add_done_callback(self._batches.discard)
+
+    async def _run(
+        self,
+        batch: list[tuple[Bank.TransferRequest, asyncio.Future[None]]],
+    ) -> None:
+        try:
+            if len(batch) == 1:
+                request, future = batch[0]
+                await self._transfer(request, future)
+                return
+
+            # Use the same idempotency key for every attempt so that
+            # retrying after an indeterminate failure can't apply the
+            # batch twice.
+            key = uuid.uuid4()
+            for attempt in range(MAX_ATTEMPTS):
+                try:
+                    await Bank.ref(self._bank_id).idempotently(
+                        key=key,
+                    ).transfer_batch(
+                        self._context,
+                        transfers=[request for request, _ in batch],
+                    )
+                except Bank.TransferBatchAborted:
+                    # The batch was rolled back, e.g., because of an
+                    # overdraft or an account that doesn't exist, so
+                    # retry each transfer on its own, in arrival order,
+                    # to give every caller its own result.
+                    for request, future in batch:
+                        await self._transfer(request, future)
+                    return
+                except Exception:
+                    if attempt == MAX_ATTEMPTS - 1:
+                        raise
+                else:
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_result(None)
+                    return
+        except Exception as exception:
+            # We can't tell whether or not the batch was applied, so
+            # every caller gets the error and nothing is retried.
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(exception)
+        finally:
+            # E.g., if we were cancelled at shutdown, make sure no
+            # caller waits forever.
+            for _, future in batch:
+                if not future.done():
+                    future.cancel()
+
+    async def _transfer(
+        self,
+        request: Bank.TransferRequest,
+        future: asyncio.Future[None],
+    ) -> None:
+        key = uuid.uuid4()
+        for attempt in range(MAX_ATTEMPTS):
+            try:
+                await Bank.ref(self._bank_id).idempotently(
+                    key=key,
+                ).transfer(self._context, request)
+            except Bank.TransferAborted as aborted:
+                if not future.done():
+                    future.set_exception(aborted)
+                return
+            except Exception as exception:
+                if attempt == MAX_ATTEMPTS - 1:
+                    if not future.done():
+                        future.set_exception(exception)
+                    return
+            else:
+                if not future.done():
+                    future.set_result(None)
+                return
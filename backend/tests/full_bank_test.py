@@ -1,3 +1,5 @@
+import asyncio
+import time
 import unittest
 from account_servicer import AccountServicer
 from bank.v1.proto.customer_rbt import Customer
@@ -6,19 +8,26 @@ from bank.v1.pydantic.account_rbt import Account
 from bank.v1.pydantic.bank import (
     AccountBalancesResponse,
     AllCustomerIdsResponse,
+    InvalidCustomerIdsRequestError,
     SignUpRequest,
     TransferRequest,
 )
 from bank.v1.pydantic.bank_rbt import Bank
 from bank_servicer import BankServicer
 from customer_servicer import CustomerServicer
+from datetime import timedelta
 from google.protobuf.message import Message
 from rbt.v1alpha1 import errors_pb2
 from reboot.aio.applications import Application
 from reboot.aio.auth.authorizers import allow, allow_if
-from reboot.aio.contexts import ReaderContext, WriterContext
+from reboot.aio.contexts import (
+    ReaderContext,
+    TransactionContext,
+    WriterContext,
+)
 from reboot.aio.tests import Reboot
 from reboot.std.collections.v1.sorted_map import sorted_map_library
+from transfer_coalescer import TransferCoalescer
 from typing import Optional
 
 BANK_ID = 'test-bank'
@@ -31,7 +40,8 @@ class BankServicerWithAuthorizer(BankServicer):
         def one_rule_for_all_methods(
             context: ReaderContext,
             state: Bank.State,
-            request: Bank.SignUpRequest | Bank.TransferRequest |
+            request: Bank.SignUpRequest | Bank.AllCustomerIdsRequest |
+            Bank.TransferRequest | Bank.TransferBatchRequest |
             Bank.OpenCustomerAccountRequest | None,
             **kwargs,
         ):
@@ -46,7 +56,9 @@ class BankServicerWithAuthorizer(BankServicer):
                     request,
                     (
                         Bank.SignUpRequest,
+                        Bank.AllCustomerIdsRequest,
                         Bank.TransferRequest,
+                        Bank.TransferBatchRequest,
                         Bank.OpenCustomerAccountRequest,
                     ),
                 )
@@ -56,6 +68,28 @@ class BankServicerWithAuthorizer(BankServicer):
         return allow_if(all=[one_rule_for_all_methods])
 
 
+class BankServicerCountingTransfers(BankServicerWithAuthorizer):
+    # Lets tests check how transfers reached the bank.
+    transfer_calls = 0
+    transfer_batch_calls = 0
+
+    async def transfer(
+        self,
+        context: TransactionContext,
+        request: Bank.TransferRequest,
+    ) -> None:
+        BankServicerCountingTransfers.transfer_calls += 1
+        await super().transfer(context, request)
+
+    async def transfer_batch(
+        self,
+        context: TransactionContext,
+        request: Bank.TransferBatchRequest,
+    ) -> None:
+        BankServicerCountingTransfers.transfer_batch_calls += 1
+        await super().transfer_batch(context, request)
+
+
 class AccountServicerWithNoInterestAndAuthorizer(AccountServicer):
 
     def authorizer(self):
@@ -234,6 +268,292 @@ class TestBank(unittest.IsolatedAsyncioTestCase):
         assert isinstance(balance_response_2, BalanceResponse)
         self.assertEqual(balance_response_2.amount, 250.0)
 
+    async def test_all_customer_ids_pagination(self) -> None:
+        await self.rbt.up(
+            Application(
+                servicers=[
+                    BankServicerWithAuthorizer,
+                    AccountServicerWithNoInterestAndAuthorizer,
+                    CustomerServicer,
+                ],
+                libraries=[sorted_map_library()],
+            )
+        )
+        context = self.rbt.create_external_context(name=f"test-{self.id()}")
+        bank, _ = await Bank.create(context, BANK_ID)
+
+        before_sign_up_ms = int(time.time() * 1000)
+
+        CUSTOMER_IDS = [f"test{i}@reboot.dev" for i in range(5)]
+        for customer_id in CUSTOMER_IDS:
+            await bank.sign_up(context, customer_id=customer_id)
+
+        # Sign ups in the same millisecond may be listed in any order,
+        # so only check what the API guarantees: pages don't overlap,
+        # together they list every customer, and ranges are respected.
+
+        # Page through all customers, two at a time.
+        customer_ids: list[str] = []
+        page_token: Optional[str] = None
+        while True:
+            response = await bank.all_customer_ids(
+                context,
+                limit=2,
+                page_token=page_token,
+            )
+            assert isinstance(response, AllCustomerIdsResponse)
+            self.assertLessEqual(len(response.customer_ids), 2)
+            customer_ids.extend(response.customer_ids)
+            if response.next_page_token is None:
+                break
+            page_token = response.next_page_token
+
+        self.assertCountEqual(customer_ids, CUSTOMER_IDS)
+
+        # Filter on sign up time.
+        response = await bank.all_customer_ids(
+            context,
+            created_after_ms=before_sign_up_ms,
+        )
+        assert isinstance(response, AllCustomerIdsResponse)
+        self.assertCountEqual(response.customer_ids, CUSTOMER_IDS)
+
+        response = await bank.all_customer_ids(
+            context,
+            created_before_ms=before_sign_up_ms,
+        )
+        assert isinstance(response, AllCustomerIdsResponse)
+        self.assertEqual(response.customer_ids, [])
+
+        # Page tokens are keys, so they can also be used as the bounds
+        # of a `start_key`/`end_key` range.
+        response = await bank.all_customer_ids(context, limit=1)
+        assert isinstance(response, AllCustomerIdsResponse)
+        start_key = response.next_page_token
+        response = await bank.all_customer_ids(context, limit=4)
+        assert isinstance(response, AllCustomerIdsResponse)
+        end_key = response.next_page_token
+        assert start_key is not None and end_key is not None
+
+        response = await bank.all_customer_ids(
+            context,
+            start_key=start_key,
+            end_key=end_key,
+        )
+        assert isinstance(response, AllCustomerIdsResponse)
+        self.assertEqual(response.customer_ids, customer_ids[1:4])
+        self.assertIsNone(response.next_page_token)
+
+        response = await bank.all_customer_ids(
+            context,
+            start_key=end_key,
+            end_key=start_key,
+        )
+        assert isinstance(response, AllCustomerIdsResponse)
+        self.assertEqual(response.customer_ids, [])
+
+        # Invalid requests are rejected rather than silently ignored.
+        for invalid_request in [
+            {'limit': -1},
+            {'limit': 0},
+            {'limit': 1001},
+            {'created_after_ms': -1},
+            {'created_before_ms': 2**48},
+        ]:
+            with self.assertRaises(Bank.AllCustomerIdsAborted) as aborted:
+                await bank.all_customer_ids(context, **invalid_request)
+            self.assertIsInstance(
+                aborted.exception.error,
+                InvalidCustomerIdsRequestError,
+            )
+
+    async def test_transfer_coalescer(self) -> None:
+        await self.rbt.up(
+            Application(
+                servicers=[
+                    BankServicerCountingTransfers,
+                    AccountServicerWithNoInterestAndAuthorizer,
+                    CustomerServicer,
+                ],
+                libraries=[sorted_map_library()],
+            )
+        )
+        context = self.rbt.create_external_context(name=f"test-{self.id()}")
+        await Bank.create(context, BANK_ID)
+
+        BankServicerCountingTransfers.transfer_calls = 0
+        BankServicerCountingTransfers.transfer_batch_calls = 0
+
+        ACCOUNT_ID_1 = "test-coalescer-account-1"
+        ACCOUNT_ID_2 = "test-coalescer-account-2"
+        ACCOUNT_ID_3 = "test-coalescer-account-3"
+        ACCOUNT_ID_4 = "test-coalescer-account-4"
+
+        account_1, _ = await Account.open(context, ACCOUNT_ID_1)
+        account_2, _ = await Account.open(context, ACCOUNT_ID_2)
+        account_3, _ = await Account.open(context, ACCOUNT_ID_3)
+        account_4, _ = await Account.open(context, ACCOUNT_ID_4)
+        await account_1.deposit(context, amount=100.0)
+
+        async def assert_balance(account, amount: float) -> None:
+            balance_response = await account.balance(context)
+            assert isinstance(balance_response, BalanceResponse)
+            self.assertEqual(balance_response.amount, amount)
+
+        coalescer = TransferCoalescer(context, BANK_ID)
+
+        # Transfers back and forth are netted into a single batch.
+        await asyncio.gather(
+            *[
+                coalescer.transfer(
+                    TransferRequest(
+                        from_account_id=ACCOUNT_ID_1,
+                        to_account_id=ACCOUNT_ID_2,
+                        amount=10.0,
+                    )
+                ) for _ in range(5)
+            ],
+            coalescer.transfer(
+                TransferRequest(
+                    from_account_id=ACCOUNT_ID_2,
+                    to_account_id=ACCOUNT_ID_1,
+                    amount=20.0,
+                )
+            ),
+        )
+
+        self.assertEqual(BankServicerCountingTransfers.transfer_batch_calls, 1)
+        self.assertEqual(BankServicerCountingTransfers.transfer_calls, 0)
+
+        await assert_balance(account_1, 70.0)
+        await assert_balance(account_2, 30.0)
+
+        # Transfers that cancel out must not leave floating point noise
+        # that overdraws an empty account.
+        await asyncio.gather(
+            *[
+                coalescer.transfer(
+                    TransferRequest(
+                        from_account_id=ACCOUNT_ID_3,
+                        to_account_id=ACCOUNT_ID_4,
+                        amount=amount,
+                    )
+                ) for amount in [0.1, 0.2]
+            ],
+            coalescer.transfer(
+                TransferRequest(
+                    from_account_id=ACCOUNT_ID_4,
+                    to_account_id=ACCOUNT_ID_3,
+                    amount=0.3,
+                )
+            ),
+        )
+
+        self.assertEqual(BankServicerCountingTransfers.transfer_batch_calls, 2)
+        self.assertEqual(BankServicerCountingTransfers.transfer_calls, 0)
+
+        await assert_balance(account_3, 0.0)
+        await assert_balance(account_4, 0.0)
+
+        # A full batch is flushed right away rather than after the
+        # window.
+        full_batch_coalescer = TransferCoalescer(
+            context,
+            BANK_ID,
+            window=timedelta(hours=1),
+            max_batch_size=2,
+        )
+
+        await asyncio.gather(
+            *[
+                full_batch_coalescer.transfer(
+                    TransferRequest(
+                        from_account_id=ACCOUNT_ID_1,
+                        to_account_id=ACCOUNT_ID_2,
+                        amount=1.0,
+                    )
+                ) for _ in range(4)
+            ]
+        )
+
+        self.assertEqual(BankServicerCountingTransfers.transfer_batch_calls, 4)
+        self.assertEqual(BankServicerCountingTransfers.transfer_calls, 0)
+
+        await assert_balance(account_1, 66.0)
+        await assert_balance(account_2, 34.0)
+
+        # A transfer to an account that doesn't exist aborts the
+        # batch, but the other callers' transfers still succeed.
+        results = await asyncio.gather(
+            coalescer.transfer(
+                TransferRequest(
+                    from_account_id=ACCOUNT_ID_1,
+                    to_account_id=ACCOUNT_ID_2,
+                    amount=1.0,
+                )
+            ),
+            coalescer.transfer(
+                TransferRequest(
+                    from_account_id=ACCOUNT_ID_1,
+                    to_account_id="test-coalescer-unopened-account",
+                    amount=1.0,
+                )
+            ),
+            coalescer.transfer(
+                TransferRequest(
+                    from_account_id=ACCOUNT_ID_2,
+                    to_account_id=ACCOUNT_ID_1,
+                    amount=2.0,
+                )
+            ),
+            return_exceptions=True,
+        )
+
+        self.assertIsNone(results[0])
+        self.assertIsInstance(results[1], Bank.TransferAborted)
+        self.assertIsNone(results[2])
+
+        self.assertEqual(BankServicerCountingTransfers.transfer_batch_calls, 5)
+        self.assertEqual(BankServicerCountingTransfers.transfer_calls, 3)
+
+        await assert_balance(account_1, 67.0)
+        await assert_balance(account_2, 33.0)
+
+        # An overdraft aborts the batch, but only the overdrawing
+        # transfer's caller should see an error, the same one that
+        # calling `Bank.transfer` directly gives.
+        results = await asyncio.gather(
+            coalescer.transfer(
+                TransferRequest(
+                    from_account_id=ACCOUNT_ID_1,
+                    to_account_id=ACCOUNT_ID_2,
+                    amount=50.0,
+                )
+            ),
+            coalescer.transfer(
+                TransferRequest(
+                    from_account_id=ACCOUNT_ID_2,
+                    to_account_id=ACCOUNT_ID_1,
+                    amount=1000.0,
+                )
+            ),
+            return_exceptions=True,
+        )
+
+        self.assertIsNone(results[0])
+        overdraft = results[1]
+        assert isinstance(overdraft, Bank.TransferAborted)
+        assert isinstance(overdraft.error, OverdraftError)
+        # The retries run in arrival order, so the first transfer has
+        # already been applied.
+        self.assertEqual(overdraft.error.amount, 917.0)
+
+        self.assertEqual(BankServicerCountingTransfers.transfer_batch_calls, 6)
+        self.assertEqual(BankServicerCountingTransfers.transfer_calls, 5)
+
+        await assert_balance(account_1, 17.0)
+        await assert_balance(account_2, 83.0)
+
     async def test_overdraft(self) -> None:
         await self.rbt.up(
             Application(